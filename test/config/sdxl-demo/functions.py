@@ -5,12 +5,19 @@ Uses ModelRef injection for automatic model loading, caching, and lifecycle.
 A custom runtime loader handles fp16 dtype and variant settings.
 """
 
-from io import BytesIO
-from typing import Annotated, Optional
+import importlib.util
+import logging
+import os
+import threading
+from typing import Annotated, Literal, Optional
 
+import cv2
 import msgspec
+import numpy as np
 import torch
+import torch.nn.functional as F
 from diffusers import AutoPipelineForText2Image
+from diffusers.models.attention_processor import AttnProcessor2_0
 from gen_worker import ActionContext, worker_function
 from gen_worker.injection import (
     ModelArtifacts,
@@ -19,6 +26,8 @@ from gen_worker.injection import (
     register_runtime_loader,
 )
 
+logger = logging.getLogger(__name__)
+
 
 def _load_sdxl_turbo_pipeline(
     ctx: ActionContext,
@@ -33,19 +42,221 @@ def _load_sdxl_turbo_pipeline(
 
     device = str(ctx.device)
     is_gpu = device != "cpu"
+    low_vram = is_gpu and os.getenv("COZY_LOW_VRAM") == "1"
 
     pipeline = AutoPipelineForText2Image.from_pretrained(
         model_id,
         torch_dtype=torch.float16 if is_gpu else torch.float32,
         variant="fp16" if is_gpu else None,
-    ).to(device)
+    )
+    if low_vram:
+        # Keep only the currently executing submodule in VRAM
+        pipeline.enable_model_cpu_offload(device=device)
+    else:
+        pipeline.to(device)
+
+    if is_gpu:
+        _enable_efficient_attention(pipeline)
+        # NHWC lets cuDNN pick tensor-core conv kernels without transposes
+        pipeline.unet.to(memory_format=torch.channels_last)
+        pipeline.vae.to(memory_format=torch.channels_last)
+        if pipeline.vae.config.force_upcast:
+            _upcast_vae(pipeline)
+        # CUDA graphs need weights resident on the device, which offload breaks
+        compiler = "none" if low_vram else os.getenv("COZY_SDXL_COMPILER", "inductor")
+        quant = os.getenv("COZY_SDXL_QUANT")
+        if quant and compiler == "none":
+            # Uncompiled torchao dynamic quantization runs slower than fp16
+            logger.warning(
+                "COZY_SDXL_QUANT=%s needs a compiled UNet (compiler is none or "
+                "COZY_LOW_VRAM is set); keeping fp16 UNet",
+                quant,
+            )
+        elif quant:
+            _quantize_unet(pipeline, device, quant)
+        if compiler == "inductor":
+            _compile_pipeline(pipeline)
+        elif compiler == "sfast":
+            _compile_with_stable_fast(pipeline)
+        elif compiler != "none":
+            raise ValueError(f"unsupported COZY_SDXL_COMPILER value: {compiler!r}")
 
     return pipeline
 
 
+def _enable_efficient_attention(pipeline: AutoPipelineForText2Image) -> None:
+    """Use fused SDPA attention, or xFormers on torch builds without it."""
+    if hasattr(F, "scaled_dot_product_attention"):
+        pipeline.unet.set_attn_processor(AttnProcessor2_0())
+        pipeline.vae.set_attn_processor(AttnProcessor2_0())
+    else:
+        pipeline.enable_xformers_memory_efficient_attention()
+
+
+def _upcast_vae(pipeline: AutoPipelineForText2Image) -> None:
+    """Keep the VAE in fp32 so the pipeline stops recasting it on every decode."""
+    vae = pipeline.vae
+    dtype = vae.dtype
+    vae.to(dtype=torch.float32)
+    vae.post_quant_conv.to(dtype=dtype)
+    vae.decoder.conv_in.to(dtype=dtype)
+    vae.decoder.mid_block.to(dtype=dtype)
+    vae.register_to_config(force_upcast=False)
+
+
+def _quantize_unet(pipeline: AutoPipelineForText2Image, device: str, mode: str) -> None:
+    """Quantize the UNet's linear layers with torchao ("fp8" or "int8")."""
+    if torch.device(device).type != "cuda":
+        logger.warning("COZY_SDXL_QUANT needs a CUDA device, got %s; keeping fp16 UNet", device)
+        return
+
+    try:
+        from torchao.quantization import (
+            float8_dynamic_activation_float8_weight,
+            int8_dynamic_activation_int8_weight,
+            quantize_,
+        )
+    except ImportError:
+        logger.warning("COZY_SDXL_QUANT=%s set but torchao is not installed", mode)
+        return
+
+    if mode == "fp8":
+        if torch.cuda.get_device_capability(torch.device(device)) < (8, 9):
+            logger.warning("fp8 quantization needs SM 8.9+, keeping fp16 UNet")
+            return
+        quantize_(pipeline.unet, float8_dynamic_activation_float8_weight())
+    elif mode == "int8":
+        quantize_(pipeline.unet, int8_dynamic_activation_int8_weight())
+    else:
+        raise ValueError(f"unsupported COZY_SDXL_QUANT value: {mode!r}")
+
+
+def _compile_pipeline(pipeline: AutoPipelineForText2Image) -> None:
+    """Compile the UNet and VAE decoder in place, falling back to eager on failure."""
+    unet, decoder = pipeline.unet, pipeline.vae.decoder
+    try:
+        pipeline.unet = torch.compile(
+            unet, mode="reduce-overhead", fullgraph=True, dynamic=True
+        )
+        pipeline.vae.decoder = torch.compile(
+            decoder, mode="reduce-overhead", fullgraph=True, dynamic=True
+        )
+        _warmup_pipeline(pipeline)
+    except Exception:
+        logger.warning("torch.compile failed, using eager pipeline", exc_info=True)
+        pipeline.unet, pipeline.vae.decoder = unet, decoder
+
+
+def _compile_with_stable_fast(pipeline: AutoPipelineForText2Image) -> None:
+    """Compile the pipeline with stable-fast, capturing CUDA graphs per shape."""
+    try:
+        from sfast.compilers.stable_diffusion_pipeline_compiler import (
+            CompilationConfig,
+            compile as sfast_compile,
+        )
+    except ImportError:
+        logger.warning("COZY_SDXL_COMPILER=sfast set but stable-fast is not installed")
+        return
+
+    config = CompilationConfig.Default()
+    config.enable_cuda_graph = True
+    config.enable_xformers = importlib.util.find_spec("xformers") is not None
+    config.enable_triton = importlib.util.find_spec("triton") is not None
+
+    modules = [pipeline.unet, pipeline.vae, pipeline.text_encoder, pipeline.text_encoder_2]
+    try:
+        sfast_compile(pipeline, config)
+        _warmup_pipeline(pipeline)
+    except Exception:
+        logger.warning("stable-fast compile failed, using eager pipeline", exc_info=True)
+        for module in modules:
+            for attr in ("forward", "decode", "encode"):
+                module.__dict__.pop(attr, None)
+
+
+def _warmup_pipeline(pipeline: AutoPipelineForText2Image) -> None:
+    """Run throwaway generations at the default GenerateInput settings."""
+    with torch.inference_mode():
+        for guidance_scale, num_images in ((0.0, 1), (2.0, 2)):
+            pipeline(
+                prompt="warmup",
+                num_inference_steps=4,
+                guidance_scale=guidance_scale,
+                width=512,
+                height=512,
+                num_images_per_prompt=num_images,
+                output_type="pt",
+            )
+
+
 register_runtime_loader(AutoPipelineForText2Image, _load_sdxl_turbo_pipeline)
 
 
+ImageFormat = Literal["png", "webp"]
+
+_ENCODE_PARAMS = {
+    "png": [cv2.IMWRITE_PNG_COMPRESSION, 1],
+    "webp": [cv2.IMWRITE_WEBP_QUALITY, 90],
+}
+
+
+def _to_bgr_uint8(images: torch.Tensor) -> np.ndarray:
+    """Convert NCHW float images in [0, 1] to an NHWC uint8 BGR array."""
+    images = images.mul(255).round_().clamp_(0, 255).to(torch.uint8)
+    images = images.flip(1).permute(0, 2, 3, 1)
+    if images.device.type == "cpu":
+        return images.contiguous().numpy()
+    host = torch.empty(
+        images.shape, dtype=torch.uint8, pin_memory=images.device.type == "cuda"
+    )
+    host.copy_(images)
+    return host.numpy()
+
+
+def _encode_image(image: np.ndarray, fmt: ImageFormat) -> bytes:
+    """Encode an HWC uint8 BGR image with OpenCV (PNG at zlib level 1, WebP q90)."""
+    ok, buf = cv2.imencode(f".{fmt}", image, _ENCODE_PARAMS[fmt])
+    if not ok:
+        raise RuntimeError(f"{fmt.upper()} encoding failed")
+    return buf.tobytes()
+
+
+# Per-thread caches: a generator reseeded by one invocation must not be
+# shared with another invocation that is still sampling from it.
+_LOCAL = threading.local()
+
+
+def _get_generator(device: torch.device | str, seed: int) -> torch.Generator:
+    """Return this thread's cached generator for ``device``, reseeded with ``seed``."""
+    cache = getattr(_LOCAL, "generators", None)
+    if cache is None:
+        cache = _LOCAL.generators = {}
+    key = str(device)
+    generator = cache.get(key)
+    if generator is None:
+        generator = cache[key] = torch.Generator(device=device)
+    return generator.manual_seed(seed)
+
+
+def _get_latents(
+    pipeline: AutoPipelineForText2Image,
+    device: torch.device | str,
+    height: int,
+    width: int,
+    batch_size: int,
+    generator: Optional[torch.Generator],
+) -> torch.Tensor:
+    """Fill this thread's latent buffer with noise, reallocating it on a new shape."""
+    dtype = pipeline.unet.dtype
+    key = (str(device), dtype, batch_size, height, width)
+    if getattr(_LOCAL, "latents_key", None) != key:
+        scale = pipeline.vae_scale_factor
+        shape = (batch_size, pipeline.unet.config.in_channels, height // scale, width // scale)
+        _LOCAL.latents = torch.empty(shape, dtype=dtype, device=device)
+        _LOCAL.latents_key = key
+    return _LOCAL.latents.normal_(generator=generator)
+
+
 class GenerateInput(msgspec.Struct):
     prompt: str
     num_steps: int = 4
@@ -53,12 +264,15 @@ class GenerateInput(msgspec.Struct):
     height: int = 512
     seed: Optional[int] = None
     guidance_scale: float = 0.0
+    format: ImageFormat = "png"
+    num_images: Annotated[int, msgspec.Meta(ge=1, le=8)] = 1
 
 
 class GenerateOutput(msgspec.Struct):
-    image_url: str
+    image_url: str  # first image, kept for single-image callers
     prompt: str
     settings: dict
+    image_urls: list[str] = []
 
 
 class GenerateBase64Input(msgspec.Struct):
@@ -67,6 +281,7 @@ class GenerateBase64Input(msgspec.Struct):
     width: int = 512
     height: int = 512
     seed: Optional[int] = None
+    format: ImageFormat = "png"
 
 
 class GenerateBase64Output(msgspec.Struct):
@@ -84,39 +299,45 @@ def generate(
     ],
     payload: GenerateInput,
 ) -> GenerateOutput:
-    """Generate an image and save to file store."""
+    """Generate one or more images and save to file store."""
     generator = None
     if payload.seed is not None:
-        generator = torch.Generator(device=ctx.device).manual_seed(payload.seed)
+        generator = _get_generator(ctx.device, payload.seed)
 
-    image = pipeline(
-        prompt=payload.prompt,
-        num_inference_steps=payload.num_steps,
-        guidance_scale=payload.guidance_scale,
-        width=payload.width,
-        height=payload.height,
-        generator=generator,
-    ).images[0]
+    latents = _get_latents(
+        pipeline, ctx.device, payload.height, payload.width, payload.num_images, generator
+    )
+    with torch.inference_mode():
+        images = pipeline(
+            prompt=payload.prompt,
+            num_inference_steps=payload.num_steps,
+            guidance_scale=payload.guidance_scale,
+            width=payload.width,
+            height=payload.height,
+            num_images_per_prompt=payload.num_images,
+            generator=generator,
+            latents=latents,
+            output_type="pt",
+        ).images
+    images = _to_bgr_uint8(images)
 
-    buffer = BytesIO()
-    image.save(buffer, format="PNG")
-    buffer.seek(0)
+    image_urls = []
+    for i, image in enumerate(images):
+        name = "image" if payload.num_images == 1 else f"image_{i}"
+        asset = ctx.save_bytes(
+            f"runs/{ctx.run_id}/outputs/{name}.{payload.format}",
+            _encode_image(image, payload.format),
+        )
+        image_urls.append(asset.ref)
 
-    asset = ctx.save_bytes(
-        f"runs/{ctx.run_id}/outputs/image.png",
-        buffer.getvalue(),
-    )
+    settings = msgspec.structs.asdict(payload)
+    del settings["prompt"]
 
     return GenerateOutput(
-        image_url=asset.ref,
+        image_url=image_urls[0],
         prompt=payload.prompt,
-        settings={
-            "num_steps": payload.num_steps,
-            "width": payload.width,
-            "height": payload.height,
-            "seed": payload.seed,
-            "guidance_scale": payload.guidance_scale,
-        },
+        settings=settings,
+        image_urls=image_urls,
     )
 
 
@@ -132,32 +353,32 @@ def generate_base64(
     """Generate an image and save to file store."""
     generator = None
     if payload.seed is not None:
-        generator = torch.Generator(device=ctx.device).manual_seed(payload.seed)
+        generator = _get_generator(ctx.device, payload.seed)
 
-    image = pipeline(
-        prompt=payload.prompt,
-        num_inference_steps=payload.num_steps,
-        guidance_scale=0.0,
-        width=payload.width,
-        height=payload.height,
-        generator=generator,
-    ).images[0]
-
-    buffer = BytesIO()
-    image.save(buffer, format="PNG")
+    latents = _get_latents(pipeline, ctx.device, payload.height, payload.width, 1, generator)
+    with torch.inference_mode():
+        images = pipeline(
+            prompt=payload.prompt,
+            num_inference_steps=payload.num_steps,
+            guidance_scale=0.0,
+            width=payload.width,
+            height=payload.height,
+            generator=generator,
+            latents=latents,
+            output_type="pt",
+        ).images
+    image = _to_bgr_uint8(images)[0]
 
     asset = ctx.save_bytes(
-        f"runs/{ctx.run_id}/outputs/image.png",
-        buffer.getvalue(),
+        f"runs/{ctx.run_id}/outputs/image.{payload.format}",
+        _encode_image(image, payload.format),
     )
 
+    settings = msgspec.structs.asdict(payload)
+    del settings["prompt"]
+
     return GenerateBase64Output(
         image_url=asset.ref,
         prompt=payload.prompt,
-        settings={
-            "num_steps": payload.num_steps,
-            "width": payload.width,
-            "height": payload.height,
-            "seed": payload.seed,
-        },
+        settings=settings,
     )
@@ -8,14 +8,92 @@ Works on:
 - CPU - fallback (slow but works)
 """
 
-from io import BytesIO
-from typing import Annotated, Optional
+import threading
+from typing import Annotated, Literal, Optional
 
+import cv2
 import msgspec
+import numpy as np
 import torch
 from diffusers import AutoPipelineForText2Image
 from gen_worker import worker_function, ActionContext, ModelRef, ModelRefSource
 
+ImageFormat = Literal["png", "webp"]
+
+# PNG at zlib level 1 is much faster than Pillow's default level 6 for a small
+# size cost; WebP q90 is several times smaller still for lossy-tolerant callers
+_ENCODE_PARAMS = {
+    "png": [cv2.IMWRITE_PNG_COMPRESSION, 1],
+    "webp": [cv2.IMWRITE_WEBP_QUALITY, 90],
+}
+_MIME_TYPES = {"png": "image/png", "webp": "image/webp"}
+
+
+def _to_bgr_uint8(images: torch.Tensor) -> np.ndarray:
+    """Convert NCHW float images in [0, 1] to an NHWC uint8 BGR array."""
+    images = images.mul(255).round_().clamp_(0, 255).to(torch.uint8)
+    images = images.flip(1).permute(0, 2, 3, 1)
+    if images.device.type == "cpu":
+        return images.contiguous().numpy()
+    host = torch.empty(
+        images.shape, dtype=torch.uint8, pin_memory=images.device.type == "cuda"
+    )
+    host.copy_(images)
+    return host.numpy()
+
+
+def _encode_image_buffer(image: np.ndarray, fmt: ImageFormat) -> np.ndarray:
+    """Encode an HWC uint8 BGR image as ``fmt``.
+
+    Returns OpenCV's uint8 output buffer, which can be handed to anything
+    that accepts a bytes-like object without copying it into ``bytes``.
+    """
+    ok, buf = cv2.imencode(f".{fmt}", image, _ENCODE_PARAMS[fmt])
+    if not ok:
+        raise RuntimeError(f"{fmt.upper()} encoding failed")
+    return buf
+
+
+def _encode_image(image: np.ndarray, fmt: ImageFormat) -> bytes:
+    """Encode an HWC uint8 BGR image as ``fmt`` bytes."""
+    return _encode_image_buffer(image, fmt).tobytes()
+
+
+# Per-thread caches: a generator reseeded by one invocation must not be
+# shared with another invocation that is still sampling from it.
+_LOCAL = threading.local()
+
+
+def _get_generator(device: torch.device | str, seed: int) -> torch.Generator:
+    """Return this thread's cached generator for ``device``, reseeded with ``seed``."""
+    cache = getattr(_LOCAL, "generators", None)
+    if cache is None:
+        cache = _LOCAL.generators = {}
+    key = str(device)
+    generator = cache.get(key)
+    if generator is None:
+        generator = cache[key] = torch.Generator(device=device)
+    return generator.manual_seed(seed)
+
+
+def _get_latents(
+    pipeline: AutoPipelineForText2Image,
+    device: torch.device | str,
+    height: int,
+    width: int,
+    batch_size: int,
+    generator: Optional[torch.Generator],
+) -> torch.Tensor:
+    """Fill this thread's latent buffer with noise, reallocating it on a new shape."""
+    dtype = pipeline.unet.dtype
+    key = (str(device), dtype, batch_size, height, width)
+    if getattr(_LOCAL, "latents_key", None) != key:
+        scale = pipeline.vae_scale_factor
+        shape = (batch_size, pipeline.unet.config.in_channels, height // scale, width // scale)
+        _LOCAL.latents = torch.empty(shape, dtype=dtype, device=device)
+        _LOCAL.latents_key = key
+    return _LOCAL.latents.normal_(generator=generator)
+
 
 class GenerateInput(msgspec.Struct):
     """Input for the generate function."""
@@ -25,13 +103,17 @@ class GenerateInput(msgspec.Struct):
     height: int = 512
     seed: Optional[int] = None
     guidance_scale: float = 0.0  # SDXL-Turbo doesn't need guidance
+    format: ImageFormat = "png"
+    # Images generated in one batched pipeline call
+    num_images: Annotated[int, msgspec.Meta(ge=1, le=8)] = 1
 
 
 class GenerateOutput(msgspec.Struct):
     """Output from the generate function."""
-    image_url: str
+    image_url: str  # first image, kept for single-image callers
     prompt: str
     settings: dict
+    image_urls: list[str] = []
 
 
 class GenerateBase64Input(msgspec.Struct):
@@ -41,11 +123,13 @@ class GenerateBase64Input(msgspec.Struct):
     width: int = 512
     height: int = 512
     seed: Optional[int] = None
+    format: ImageFormat = "png"
 
 
 class GenerateBase64Output(msgspec.Struct):
     """Output from the generate_base64 function."""
     image_base64: str
+    mime_type: str
     prompt: str
     settings: dict
 
@@ -60,7 +144,7 @@ def generate(
     ],
 ) -> GenerateOutput:
     """
-    Generate an image from a text prompt and save to file store.
+    Generate one or more images from a text prompt and save to file store.
 
     The pipeline is automatically injected by the worker runtime's model cache.
     This avoids global mutable state and enables proper model management.
@@ -71,45 +155,49 @@ def generate(
         pipeline: SDXL-Turbo pipeline, injected by the worker runtime
 
     Returns:
-        GenerateOutput containing the URL to the saved image
+        GenerateOutput containing the URLs of the saved images
     """
     # Set seed for reproducibility
     generator = None
     if payload.seed is not None:
-        generator = torch.Generator(device=ctx.device).manual_seed(payload.seed)
+        generator = _get_generator(ctx.device, payload.seed)
 
     # Generate image using injected pipeline
-    image = pipeline(
-        prompt=payload.prompt,
-        num_inference_steps=payload.num_steps,
-        guidance_scale=payload.guidance_scale,
-        width=payload.width,
-        height=payload.height,
-        generator=generator,
-    ).images[0]
-
-    # Save image to file store using ctx
-    buffer = BytesIO()
-    image.save(buffer, format="PNG")
-    buffer.seek(0)
-
-    # Use ctx to save bytes and get URL
-    image_url = ctx.save_bytes(
-        f"generated/{ctx.run_id}.png",
-        buffer.getvalue(),
-        "image/png",
+    latents = _get_latents(
+        pipeline, ctx.device, payload.height, payload.width, payload.num_images, generator
     )
+    with torch.inference_mode():
+        images = pipeline(
+            prompt=payload.prompt,
+            num_inference_steps=payload.num_steps,
+            guidance_scale=payload.guidance_scale,
+            width=payload.width,
+            height=payload.height,
+            num_images_per_prompt=payload.num_images,
+            generator=generator,
+            latents=latents,
+            output_type="pt",
+        ).images
+    images = _to_bgr_uint8(images)
+
+    # Use ctx to save bytes and get URLs
+    image_urls = []
+    for i, image in enumerate(images):
+        name = ctx.run_id if payload.num_images == 1 else f"{ctx.run_id}_{i}"
+        image_urls.append(ctx.save_bytes(
+            f"generated/{name}.{payload.format}",
+            _encode_image(image, payload.format),
+            _MIME_TYPES[payload.format],
+        ))
+
+    settings = msgspec.structs.asdict(payload)
+    del settings["prompt"]
 
     return GenerateOutput(
-        image_url=image_url,
+        image_url=image_urls[0],
         prompt=payload.prompt,
-        settings={
-            "num_steps": payload.num_steps,
-            "width": payload.width,
-            "height": payload.height,
-            "seed": payload.seed,
-            "guidance_scale": payload.guidance_scale,
-        },
+        settings=settings,
+        image_urls=image_urls,
     )
 
 
@@ -140,30 +228,35 @@ def generate_base64(
     # Set seed for reproducibility
     generator = None
     if payload.seed is not None:
-        generator = torch.Generator(device=ctx.device).manual_seed(payload.seed)
+        generator = _get_generator(ctx.device, payload.seed)
 
     # Generate image using injected pipeline
-    image = pipeline(
-        prompt=payload.prompt,
-        num_inference_steps=payload.num_steps,
-        guidance_scale=0.0,
-        width=payload.width,
-        height=payload.height,
-        generator=generator,
-    ).images[0]
+    latents = _get_latents(pipeline, ctx.device, payload.height, payload.width, 1, generator)
+    with torch.inference_mode():
+        images = pipeline(
+            prompt=payload.prompt,
+            num_inference_steps=payload.num_steps,
+            guidance_scale=0.0,
+            width=payload.width,
+            height=payload.height,
+            generator=generator,
+            latents=latents,
+            output_type="pt",
+        ).images
+    image = _to_bgr_uint8(images)[0]
 
     # Convert to base64
-    buffer = BytesIO()
-    image.save(buffer, format="PNG")
-    img_base64 = base64.b64encode(buffer.getvalue()).decode("utf-8")
+    # b64encode reads the encoder buffer directly; base64 output is pure ASCII
+    img_base64 = base64.b64encode(
+        _encode_image_buffer(image, payload.format)
+    ).decode("ascii")
+
+    settings = msgspec.structs.asdict(payload)
+    del settings["prompt"]
 
     return GenerateBase64Output(
         image_base64=img_base64,
+        mime_type=_MIME_TYPES[payload.format],
         prompt=payload.prompt,
-        settings={
-            "num_steps": payload.num_steps,
-            "width": payload.width,
-            "height": payload.height,
-            "seed": payload.seed,
-        },
+        settings=settings,
     )
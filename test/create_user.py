@@ -14,11 +14,29 @@ import argparse
 import json
 import re
 import sys
+
+import msgspec
 import requests
+from requests.adapters import HTTPAdapter
 
 
 DEFAULT_HUB_URL = "https://api.cozy.art"
 
+# \Z rather than $ so a trailing newline is rejected
+_USERNAME_RE = re.compile(r'^[a-zA-Z0-9_]+\Z')
+_PHONE_RE = re.compile(r'^\+[0-9]+\Z')
+
+# Shared session so repeated calls reuse keep-alive connections (no new TLS handshake)
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_SESSION.headers.update({"Content-Type": "application/json"})
+
+
+class _RegisterPayload(msgspec.Struct):
+    identifier: str
+    username: str
+    password: str
+
 
 def validate_username(username: str) -> None:
     """Validate username according to AuthKit rules."""
@@ -32,7 +50,7 @@ def validate_username(username: str) -> None:
     if not username[0].isalpha():
         raise ValueError("username must start with a letter")
 
-    if not re.match(r'^[a-zA-Z0-9_]+$', username):
+    if not _USERNAME_RE.match(username):
         raise ValueError("username can only contain letters, numbers, and underscores")
 
     if username.lower() in ("admin", "moderator"):
@@ -57,7 +75,7 @@ def validate_phone(phone: str) -> None:
         raise ValueError("phone number must start with + (E.164 format)")
     if len(phone) < 10:
         raise ValueError("phone number too short")
-    if not re.match(r'^\+[0-9]+$', phone):
+    if not _PHONE_RE.match(phone):
         raise ValueError("phone number can only contain digits after +")
 
 
@@ -76,21 +94,13 @@ def create_user(hub_url: str, identifier: str, username: str, password: str) ->
     """
     url = f"{hub_url.rstrip('/')}/api/v1/auth/register"
 
-    payload = {
-        "identifier": identifier,
-        "username": username,
-        "password": password,
-    }
-
-    headers = {
-        "Content-Type": "application/json",
-    }
+    body = msgspec.json.encode(_RegisterPayload(identifier, username, password))
 
-    response = requests.post(url, json=payload, headers=headers, timeout=30)
+    response = _SESSION.post(url, data=body, timeout=30)
 
     try:
-        data = response.json()
-    except json.JSONDecodeError:
+        data = msgspec.json.decode(response.content)
+    except msgspec.DecodeError:
         data = {"raw_response": response.text}
 
     if response.status_code not in (200, 201, 202):